@@ -1,30 +1,296 @@
 import os
-import pandas as pd
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from openai import OpenAI
 from dotenv import load_dotenv
 import uuid
 import threading
+import time
 import sys
 import traceback
+import hashlib
+import re
+import io
+import json
+import concurrent.futures
+import multiprocessing
+import queue
+import atexit
+from multiprocessing import shared_memory
+from collections import OrderedDict
+from html import escape
+
+import sandbox
 
 load_dotenv()
 
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=os.getenv("OPENAI_API_KEY"),
-)
+# ========== 重量级依赖懒加载（加快启动速度，降低空闲进程内存）==========
+
+_pandas = None
+_pandas_lock = threading.Lock()
+_client = None
+_client_lock = threading.Lock()
+
+def get_pandas():
+    """首次使用时才导入pandas"""
+    global _pandas
+    if _pandas is None:
+        with _pandas_lock:
+            if _pandas is None:
+                import pandas
+                sandbox.enable_copy_on_write(pandas)
+                _pandas = pandas
+    return _pandas
+
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+KEEPALIVE_INTERVAL_SECONDS = 30
+
+def _keepalive(http_client):
+    """定期向OpenRouter发送轻量请求，保持连接池中的TLS连接不因空闲而断开"""
+    while True:
+        time.sleep(KEEPALIVE_INTERVAL_SECONDS)
+        try:
+            http_client.head(f"{OPENROUTER_BASE_URL}/")
+        except Exception as e:
+            print(f"[WARNING] Keepalive ping failed: {e}")
+
+def get_client():
+    """首次调用LLM时才导入openai并创建客户端（同时启动连接保活线程）"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from openai import OpenAI, DefaultHttpxClient, DEFAULT_CONNECTION_LIMITS
+                from httpx2 import Limits  # openai SDK使用的HTTP传输库
+                # 使用SDK自带的HTTP客户端，只延长空闲连接的保活时间，其余沿用SDK默认值
+                http_client = DefaultHttpxClient(
+                    limits=Limits(
+                        max_connections=DEFAULT_CONNECTION_LIMITS.max_connections,
+                        max_keepalive_connections=max(DEFAULT_CONNECTION_LIMITS.max_keepalive_connections, 32),
+                        keepalive_expiry=120,
+                    ),
+                )
+                _client = OpenAI(
+                    base_url=OPENROUTER_BASE_URL,
+                    api_key=os.getenv("OPENAI_API_KEY"),
+                    http_client=http_client,
+                )
+                threading.Thread(target=_keepalive, args=(http_client,), daemon=True).start()
+    return _client
 
 app = Flask(__name__)
 CORS(app)
 
-UPLOAD_FOLDER = 'uploads'
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+# ========== Session存储 ==========
 
 # 简化的session存储（单用户demo，用字典即可）
-sessions = {}  # {session_id: {"df": DataFrame, "filename": str}}
+# 配置了REDIS_URL时，session会同时写入Redis，多进程部署时任意worker都能读取
+sessions = {}  # {session_id: {"df": DataFrame, "filename": str, "columns": list, "sample": dict, "shared_df": (name, size), "last_access": float}}
+sessions_lock = threading.Lock()
+# 只存在于当前进程的字段，不写入Redis
+LOCAL_SESSION_KEYS = ("df", "shared_df", "last_access")
+
+REDIS_URL = os.getenv("REDIS_URL")
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "3600"))
+
+_redis = None
+_redis_lock = threading.Lock()
+
+def get_redis():
+    """懒加载Redis客户端；未配置REDIS_URL时返回None（只使用进程内字典）"""
+    global _redis
+    if REDIS_URL and _redis is None:
+        with _redis_lock:
+            if _redis is None:
+                import redis
+                _redis = redis.Redis.from_url(REDIS_URL)
+    return _redis
+
+def session_key(session_id):
+    return f"sess:{session_id}"
+
+def expire_idle_sessions():
+    """清理超过SESSION_TTL_SECONDS未访问的本地session，并释放其共享内存和语义缓存"""
+    deadline = time.time() - SESSION_TTL_SECONDS
+    with sessions_lock:
+        expired = [sid for sid, record in sessions.items() if record["last_access"] < deadline]
+        # 只保留共享内存段的名字，session中的DataFrame视图随record一起释放
+        segments = [sessions.pop(sid)["shared_df"][0] for sid in expired]
+    for sid, name in zip(expired, segments):
+        release_shared_dataframe(name)
+        with SEMANTIC_CACHE_LOCK:
+            SEMANTIC_CACHE.pop(sid, None)
+    close_released_segments()
+
+def save_session(session_id, record):
+    """保存session；DataFrame以Arrow IPC（feather）格式写入Redis"""
+    expire_idle_sessions()
+    record["last_access"] = time.time()
+    with sessions_lock:
+        sessions[session_id] = record
+    
+    r = get_redis()
+    if r is None:
+        return
+    buf = io.BytesIO()
+    record["df"].to_feather(buf)
+    meta = {key: value for key, value in record.items() if key not in LOCAL_SESSION_KEYS}
+    key = session_key(session_id)
+    pipe = r.pipeline()
+    pipe.hset(key, mapping={"df": buf.getvalue(), "meta": json.dumps(meta, default=str)})
+    pipe.expire(key, SESSION_TTL_SECONDS)
+    pipe.execute()
+
+def get_session(session_id):
+    """读取session：优先使用进程内缓存，未命中时从Redis加载；不存在则返回None"""
+    if not session_id:
+        return None
+    expire_idle_sessions()
+    record = sessions.get(session_id)
+    if record is not None:
+        record["last_access"] = time.time()
+        return record
+    
+    r = get_redis()
+    if r is None:
+        return None
+    key = session_key(session_id)
+    stored = r.hgetall(key)
+    if not stored:
+        return None
+    r.expire(key, SESSION_TTL_SECONDS)
+    
+    record = json.loads(stored[b"meta"])
+    record["shared_df"] = share_dataframe(
+        get_pandas().read_feather(io.BytesIO(stored[b"df"]), dtype_backend="pyarrow")
+    )
+    # 与上传时相同，只保留共享内存上的视图
+    record["df"] = map_shared_dataframe(record["shared_df"])
+    record["last_access"] = time.time()
+    with sessions_lock:
+        existing = sessions.setdefault(session_id, record)
+    if existing is not record:
+        # 另一个线程已经加载了同一个session
+        del record["df"]
+        release_shared_dataframe(record["shared_df"][0])
+    return existing
+
+# ========== 语义缓存（相似问题直接复用AI生成的代码）==========
+
+SEMANTIC_CACHE = {}  # {session_id: OrderedDict{(strategy, model, question): (embedding, literals, code)}}
+SEMANTIC_CACHE_LOCK = threading.Lock()
+SEMANTIC_CACHE_MAX_ENTRIES = 128  # 每个session最多缓存的问题数（LRU淘汰）
+SEMANTIC_SIMILARITY_THRESHOLD = 0.92
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+_embedding_model = None
+_embedding_model_lock = threading.Lock()
+
+def get_embedding_model():
+    """懒加载本地embedding模型；未安装sentence-transformers时返回None（关闭语义缓存）"""
+    global _embedding_model
+    if _embedding_model is None:
+        with _embedding_model_lock:
+            if _embedding_model is None:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                    _embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+                except Exception as e:
+                    print(f"[WARNING] Semantic cache disabled: {e}")
+                    _embedding_model = False
+    return _embedding_model or None
+
+def normalize_question(question):
+    """统一大小写和空白，作为缓存的精确key"""
+    return " ".join(question.lower().split())
+
+# 问题中的字面量：数字、引号内的字符串、比较运算符
+_QUESTION_LITERAL_RE = re.compile(r"\d+(?:\.\d+)?|'[^']*'|\"[^\"]*\"|[<>]=?|[!=]=")
+
+def question_literals(question):
+    """
+    提取问题中的字面量；语义相似但字面量不同的问题（如 top 5 和 top 10）不能共用代码
+    """
+    return tuple(_QUESTION_LITERAL_RE.findall(question))
+
+def embed_question(question):
+    """返回归一化后的embedding（点积即余弦相似度）；模型不可用时返回None"""
+    model = get_embedding_model()
+    if model is None:
+        return None
+    try:
+        return model.encode(normalize_question(question), normalize_embeddings=True)
+    except Exception as e:
+        print(f"[WARNING] Embedding failed: {e}")
+        return None
+
+def semantic_cache_lookup(session_id, prompt_strategy, model_name, question, embedding):
+    """在同一session、同一策略和模型下查找相似且字面量完全相同的问题，命中则返回缓存的代码"""
+    if embedding is None:
+        return None
+    literals = question_literals(question)
+    with SEMANTIC_CACHE_LOCK:
+        entries = SEMANTIC_CACHE.get(session_id)
+        if not entries:
+            return None
+        best_key, best_score = None, SEMANTIC_SIMILARITY_THRESHOLD
+        for key, (cached_embedding, cached_literals, _) in entries.items():
+            if key[0] != prompt_strategy or key[1] != model_name or cached_literals != literals:
+                continue
+            score = float(cached_embedding @ embedding)
+            if score > best_score:
+                best_key, best_score = key, score
+        if best_key is None:
+            return None
+        entries.move_to_end(best_key)
+        print(f"[DEBUG] Semantic cache hit ({best_score:.3f}): {best_key[2]!r}")
+        return entries[best_key][2]
+
+def semantic_cache_discard(session_id, code):
+    """移除缓存了这段代码的条目（代码执行失败时调用）"""
+    with SEMANTIC_CACHE_LOCK:
+        entries = SEMANTIC_CACHE.get(session_id)
+        if not entries:
+            return
+        for key in [key for key, entry in entries.items() if entry[2] == code]:
+            del entries[key]
+
+def semantic_cache_store(session_id, prompt_strategy, model_name, question, embedding, code):
+    """缓存AI生成的代码（只在代码执行成功后调用），超过上限时淘汰最久未使用的条目"""
+    if embedding is None:
+        return
+    with SEMANTIC_CACHE_LOCK:
+        entries = SEMANTIC_CACHE.setdefault(session_id, OrderedDict())
+        key = (prompt_strategy, model_name, normalize_question(question))
+        entries[key] = (embedding, question_literals(question), code)
+        entries.move_to_end(key)
+        while len(entries) > SEMANTIC_CACHE_MAX_ENTRIES:
+            entries.popitem(last=False)
+
+# ========== 精确匹配缓存（完全相同的prompt不再请求LLM）==========
+
+RESPONSE_CACHE = OrderedDict()  # {sha256(model|system_role|prompt): content}
+RESPONSE_CACHE_LOCK = threading.Lock()
+RESPONSE_CACHE_MAX_ENTRIES = 512
+INFLIGHT_REQUESTS = {}  # {cache_key: Future}，正在进行中的LLM请求（并发的相同请求共享结果）
+
+def response_cache_key(model, system_role, prompt):
+    return hashlib.sha256(f"{model}|{system_role}|{prompt}".encode()).digest()
+
+def response_cache_discard(prompt, system_role, model_name):
+    """代码执行失败时移除缓存的回复，用户重试时重新生成"""
+    model = MODEL_MAP.get(model_name, MODEL_MAP["google"])
+    with RESPONSE_CACHE_LOCK:
+        RESPONSE_CACHE.pop(response_cache_key(model, system_role, prompt), None)
+
+def response_cache_store(prompt, system_role, model_name, content):
+    """缓存LLM回复；只在生成的代码执行成功后调用，避免把出错的代码反复返回"""
+    model = MODEL_MAP.get(model_name, MODEL_MAP["google"])
+    cache_key = response_cache_key(model, system_role, prompt)
+    with RESPONSE_CACHE_LOCK:
+        RESPONSE_CACHE[cache_key] = content
+        RESPONSE_CACHE.move_to_end(cache_key)
+        while len(RESPONSE_CACHE) > RESPONSE_CACHE_MAX_ENTRIES:
+            RESPONSE_CACHE.popitem(last=False)
 
 MODEL_MAP = {
     "google": "mistralai/mistral-large",
@@ -35,6 +301,10 @@ MODEL_MAP = {
 
 # ========== Prompt 策略库 ==========
 
+# 样例数据的大小限制（列数、每个单元格的字符数），避免宽表让prompt膨胀
+PROMPT_SAMPLE_MAX_COLUMNS = 10
+PROMPT_SAMPLE_MAX_CHARS = 80
+
 PROMPT_TEMPLATES = {
     # 策略 1: Direct / Zero-Shot (直接生成)
     # 适用场景: 简单统计，如"行数是多少"、"列名是什么"
@@ -139,125 +409,459 @@ IMPORTANT:
 """
 }
 
-# ========== 安全代码执行层（方案1：轻量级限制）==========
+# ========== AI回复解析规则（模块加载时预编译）==========
+
+# 思路注释：以#开头且包含Step、Reasoning等关键词
+_REASONING_RE = re.compile(r"#.*(step|logic|explain|approach|reason|analyze)", re.I)
+# 明显的解释文本（非代码注释）
+_SKIP_TEXT_RE = re.compile(r"(note:|example:|here|this code|the code|you can)", re.I)
+_NOTE_TEXT_RE = re.compile(r"(note|example)", re.I)
+# 重新定义df的代码行
+_DF_RECREATE_RE = re.compile(r"df\s*=\s*(pd\.)?DataFrame")
+# 已闭合的markdown代码块（代码块结束后只剩解释文本，可以提前结束流式输出）
+_CLOSED_CODE_BLOCK_RE = re.compile(r"```[^\n]*\n.*?^\s*```", re.S | re.M)
+# 顶层的result赋值
+_RESULT_ASSIGN_RE = re.compile(r"^result\s*=(?!=)", re.M)
+_CODE_START_PREFIXES = ('if ', 'for ', 'while ', 'def ')
+_CODE_CONTINUATION_PREFIXES = ('if ', 'elif ', 'else:', 'for ', 'while ', 'def ', 'return ', 'import ', 'from ')
+
+def extract_code_and_reasoning(raw):
+    """
+    从AI回复中提取可执行代码和思路注释（单次遍历）
+    
+    Args:
+        raw: AI返回的原始文本（可能包含markdown代码块标记和解释文本）
+    
+    Returns:
+        tuple: (code: str, reasoning: list[str])，reasoning为去掉#号的思路要点
+    """
+    # 移除markdown代码块标记
+    code = raw.replace("```python", "").replace("```", "").strip()
+    
+    # 提取代码：找到包含 "result" 的行，但保留注释和缩进
+    lines = code.split('\n')
+    code_lines = []
+    reasoning_lines = []  # 保存思路注释
+    reasoning = []  # 思路要点（去掉#号，用于展示）
+    
+    for line in lines:
+        line_stripped = line.strip()
+        if not line_stripped:
+            continue
+        
+        # 跳过明显的解释文本（非代码注释）
+        if _SKIP_TEXT_RE.match(line_stripped):
+            continue
+        
+        # ⚠️ 移除重新定义df的代码行（防止bug）
+        if _DF_RECREATE_RE.match(line_stripped):
+            print(f"[WARNING] Removed DataFrame recreation: {line_stripped}")
+            continue
+        
+        # 保留思路注释（以#开头的注释，特别是Step、Reasoning相关的）
+        is_comment = line_stripped.startswith('#')
+        is_reasoning = is_comment and _REASONING_RE.match(line_stripped)
+        if is_reasoning:
+            reasoning_lines.append(line)  # 保留原始格式（包括缩进）
+            reasoning_text = line_stripped.lstrip('#').strip()
+            if reasoning_text:
+                reasoning.append(reasoning_text)
+        
+        # 收集包含 result 或看起来像代码的行
+        if 'result' in line_stripped or ('=' in line_stripped and ('df' in line_stripped or 'pd' in line_stripped)) or line_stripped.startswith(_CODE_START_PREFIXES):
+            code_lines.append(line)  # 保留原始格式（包括缩进）
+        elif code_lines:  # 如果已经开始收集代码，继续收集后续行
+            # 保留所有注释行（思路注释上面已经添加过）
+            if is_comment:
+                if not is_reasoning:
+                    reasoning_lines.append(line)
+            elif not _NOTE_TEXT_RE.match(line_stripped):
+                # 检查是否是代码的延续（如if/for/while的缩进块）
+                if line[0].isspace() or line_stripped.startswith(_CODE_CONTINUATION_PREFIXES):
+                    code_lines.append(line)  # 保留原始格式（包括缩进）
+    
+    # 如果提取到代码，使用提取的；否则使用原始（去除首尾空行）
+    if code_lines:
+        # 合并思路注释和代码，保持顺序
+        # 先添加所有思路注释，然后添加代码
+        # 如果代码中有思路注释，先添加它们（已按原始顺序收集）
+        all_lines = list(reasoning_lines)
+        seen = set(reasoning_lines)  # 用集合判重，避免O(n²)的列表查找
+        # 然后添加所有代码行（包括注释）
+        for line in code_lines:
+            if line not in seen:
+                seen.add(line)
+                all_lines.append(line)
+        
+        # 如果合并后为空，使用原始代码
+        if all_lines:
+            code = '\n'.join(all_lines)
+        else:
+            code = code.strip()
+    else:
+        code = code.strip()
+    
+    # 再次检查：如果代码中仍有重新定义df，给出警告
+    if 'df = pd.DataFrame' in code or 'df = DataFrame' in code:
+        print(f"[WARNING] Code still contains DataFrame recreation, may cause error")
+    
+    return code, reasoning
+
+# ========== 简单问题路由（无需调用LLM）==========
+
+# 只对整句匹配的简单问题生效，避免误判带条件的问题（如"how many rows have ..."）
+_ROUTE_ROW_COUNT_RE = re.compile(r"(how many|number of) (rows|records)( are there| (are )?in (the )?(dataset|data|file|table))?")
+_ROUTE_COLUMNS_RE = re.compile(r"((what are|list|show)( me)? (the |all )?)?(columns|column names)")
+_ROUTE_HEAD_RE = re.compile(r"((show|display|give)( me)? )?(the )?first (\d+) rows?")
+_ROUTE_SHAPE_RE = re.compile(r"(what is )?(the )?shape( of (the )?(dataset|data|dataframe|df))?")
+# 前N行问题最多返回的行数（在Flask进程中渲染，不受沙箱的超时和内存限制保护）
+ROUTE_HEAD_MAX_ROWS = 100
+
+def route_trivial_question(question, df):
+    """
+    直接用pandas回答简单问题（行数、列名、前N行、shape）
+    
+    Returns:
+        tuple: (result, notice)，notice为需要提示用户的说明（如行数被截断），没有时为None；
+        不是简单问题时返回None
+    """
+    question = normalize_question(question).rstrip("?.! ")
+    if _ROUTE_ROW_COUNT_RE.fullmatch(question):
+        return len(df), None
+    if _ROUTE_COLUMNS_RE.fullmatch(question):
+        return list(df.columns), None
+    match = _ROUTE_HEAD_RE.fullmatch(question)
+    if match:
+        n = int(match.group(5))
+        if n > ROUTE_HEAD_MAX_ROWS:
+            notice = f"Only the first {ROUTE_HEAD_MAX_ROWS} rows are shown (requested {n})."
+            return df.head(ROUTE_HEAD_MAX_ROWS), notice
+        return df.head(n), None
+    if _ROUTE_SHAPE_RE.fullmatch(question):
+        return df.shape, None
+    return None
+
+# ========== 安全代码执行层（方案2：进程池隔离）==========
+
+# 沙箱工作进程数（同时执行AI代码的最大并发数）
+SANDBOX_POOL_SIZE = int(os.getenv("SANDBOX_POOL_SIZE", "4"))
+# 父进程等待结果的额外时间（反序列化DataFrame等），不计入代码执行超时
+SANDBOX_GRACE_SECONDS = 1
 
 class TimeoutError(Exception):
     """超时异常"""
     pass
 
-def execute_code_safely(code, df, timeout=5):
+class SandboxPool:
     """
-    安全的代码执行函数（方案1：轻量级限制）
+    预先启动的沙箱工作进程池（类似gunicorn的prefork模型），避免每个请求都启动新的Python解释器
+    
+    超时或崩溃的工作进程会被kill并替换成新进程，保证池中始终有size个可用进程。
+    """
+    def __init__(self, size):
+        methods = multiprocessing.get_all_start_methods()
+        # forkserver在多线程的Flask进程中也能安全地创建子进程，并可预加载pandas
+        self._ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        if "forkserver" in methods:
+            self._ctx.set_forkserver_preload(["sandbox", "pandas", "pyarrow"])
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(self._spawn())
+    
+    def _spawn(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        proc = self._ctx.Process(target=sandbox.worker_main, args=(child_conn,), daemon=True)
+        proc.start()
+        child_conn.close()
+        return proc, parent_conn
+    
+    def _replace(self, worker):
+        proc, conn = worker
+        proc.kill()
+        proc.join()
+        conn.close()
+        return self._spawn()
+    
+    def run(self, code, shared_df, timeout):
+        """在空闲的工作进程中执行代码；所有进程都忙时会等待"""
+        worker = self._idle.get()
+        proc, conn = worker
+        try:
+            conn.send((code, shared_df, timeout))
+            if not conn.poll(timeout + SANDBOX_GRACE_SECONDS):
+                worker = self._replace(worker)
+                return False, None, f"Code execution timeout (>{timeout}s)"
+            response = json.loads(conn.recv_bytes())
+            return response["success"], response["result"], response["error"]
+        except (EOFError, OSError):
+            # 工作进程被RLIMIT_CPU等信号终止
+            worker = self._replace(worker)
+            return False, None, f"Code execution timeout (>{timeout}s)"
+        finally:
+            self._idle.put(worker)
+
+_sandbox_pool = None
+_sandbox_pool_lock = threading.Lock()
+
+def get_sandbox_pool():
+    """首次执行代码时才创建沙箱进程池"""
+    global _sandbox_pool
+    if _sandbox_pool is None:
+        with _sandbox_pool_lock:
+            if _sandbox_pool is None:
+                _sandbox_pool = SandboxPool(SANDBOX_POOL_SIZE)
+    return _sandbox_pool
+
+# 已写入共享内存的DataFrame（父进程持有，进程退出时统一释放）
+SHARED_SEGMENTS = {}  # {name: SharedMemory}
+# 已unlink、但仍被进行中请求的DataFrame视图引用而无法关闭的段
+RELEASED_SEGMENTS = []
+RELEASED_SEGMENTS_LOCK = threading.Lock()
+
+def share_dataframe(df):
+    """
+    把DataFrame以Arrow IPC格式写入共享内存（上传时只做一次），沙箱进程按名字直接映射读取
+    
+    Returns:
+        tuple: (name: str, size: int)
+    """
+    import pyarrow as pa
+    try:
+        table = pa.Table.from_pandas(df)
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+        # C引擎解析出的object列可能混有不同类型，转换成字符串后再写入
+        print(f"[WARNING] Converting object columns to string for Arrow: {e}")
+        object_columns = df.select_dtypes(include="object").columns
+        table = pa.Table.from_pandas(df.astype({col: "string" for col in object_columns}))
+    
+    # 先计算序列化后的大小，再直接写入共享内存，避免中间缓冲区
+    mock = pa.MockOutputStream()
+    with pa.ipc.new_stream(mock, table.schema) as writer:
+        writer.write_table(table)
+    size = mock.size()
+    
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    with pa.ipc.new_stream(pa.FixedSizeBufferWriter(pa.py_buffer(shm.buf)), table.schema) as writer:
+        writer.write_table(table)
+    SHARED_SEGMENTS[shm.name] = shm
+    return shm.name, size
+
+def map_shared_dataframe(shared_df):
+    """
+    把共享内存中的DataFrame映射为父进程使用的DataFrame（与sandbox.load_shared_dataframe相同）
+    
+    ArrowDtype列直接包装共享内存上的Arrow数组，父进程不再保留一份私有副本。
+    """
+    import pyarrow as pa
+    name, size = shared_df
+    table = pa.ipc.open_stream(pa.py_buffer(SHARED_SEGMENTS[name].buf[:size])).read_all()
+    return table.to_pandas(types_mapper=get_pandas().ArrowDtype)
+
+def release_shared_dataframe(name):
+    """释放共享内存段（session过期时调用）；已映射该段的沙箱进程仍可继续使用直到自行关闭"""
+    shm = SHARED_SEGMENTS.pop(name, None)
+    if shm is None:
+        return
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+    with RELEASED_SEGMENTS_LOCK:
+        RELEASED_SEGMENTS.append(shm)
+
+def close_released_segments():
+    """关闭已释放的共享内存段；仍被DataFrame视图引用的段留到下次再关闭"""
+    with RELEASED_SEGMENTS_LOCK:
+        for shm in list(RELEASED_SEGMENTS):
+            try:
+                shm.close()
+            except BufferError:
+                continue
+            RELEASED_SEGMENTS.remove(shm)
+
+@atexit.register
+def release_shared_dataframes():
+    # 先丢弃session中的DataFrame视图，共享内存才能关闭
+    with sessions_lock:
+        sessions.clear()
+    for name in list(SHARED_SEGMENTS):
+        release_shared_dataframe(name)
+    close_released_segments()
+
+def execute_code_safely(code, shared_df, timeout=5):
+    """
+    安全的代码执行函数（方案2：进程池隔离）
     
     特性：
-    1. 超时控制（跨平台）
-    2. 命名空间限制（限制危险内置函数）
-    3. 数据保护（使用copy）
+    1. 超时控制：工作进程内用RLIMIT_CPU限制CPU时间，父进程超时后直接kill并补充新进程
+    2. 内存限制：RLIMIT_AS
+    3. 命名空间限制（限制危险内置函数，见sandbox.py）
+    4. 数据保护：工作进程从共享内存只读映射DataFrame，AI代码无法修改原始数据
     
     Args:
         code: 要执行的Python代码字符串
-        df: pandas DataFrame
+        shared_df: share_dataframe() 返回的共享内存句柄 (name, size)
         timeout: 超时时间（秒），默认5秒
     
     Returns:
-        tuple: (success: bool, result: any, error: str)
+        tuple: (success: bool, result_html: str, error: str)
     """
-    result_container = {"result": None, "error": None, "completed": False}
+    return get_sandbox_pool().run(code, shared_df, timeout)
+
+def build_prompt_sample(df):
+    """生成prompt用的样例数据：只取前几列、前两行，并截断过长的单元格，控制prompt长度"""
+    return {
+        col: [str(value)[:PROMPT_SAMPLE_MAX_CHARS] for value in df[col].head(2)]
+        for col in df.columns[:PROMPT_SAMPLE_MAX_COLUMNS]
+    }
+
+def dedup_column_names(columns):
+    """与pandas C引擎一致地处理重复列名：a, a, b -> a, a.1, b"""
+    seen = set()
+    names = []
+    for col in columns:
+        name, i = col, 0
+        while name in seen:
+            i += 1
+            name = f"{col}.{i}"
+        seen.add(name)
+        names.append(name)
+    return names
+
+def temporal_columns_to_string(df):
+    """
+    把pyarrow自动识别出的日期/时间列转回字符串，与C引擎的结果保持一致
     
-    def restricted_exec():
-        """在受限环境中执行代码"""
-        try:
-            # 1. 创建安全的内置函数字典（移除危险函数）
-            safe_builtins = {
-                # 基础类型
-                'len': len, 'str': str, 'int': int, 'float': float,
-                'bool': bool, 'list': list, 'dict': dict, 'tuple': tuple,
-                'set': set, 'frozenset': frozenset,
-                # 基础操作
-                'min': min, 'max': max, 'sum': sum, 'abs': abs,
-                'round': round, 'sorted': sorted, 'reversed': reversed,
-                'enumerate': enumerate, 'zip': zip, 'range': range,
-                # 字符串操作
-                'ord': ord, 'chr': chr, 'hex': hex, 'oct': oct, 'bin': bin,
-                # 数学函数（如果需要，可以导入math模块）
-                # 移除的危险函数：
-                # - open, file (文件操作)
-                # - __import__, import (模块导入)
-                # - eval, exec, compile (代码执行)
-                # - input, raw_input (用户输入)
-                # - exit, quit (退出)
-                # - dir, vars, globals, locals (命名空间访问)
-            }
-            
-            # 2. 限制可用的模块（只提供pandas）
-            safe_modules = {
-                'pd': pd,
-                'pandas': pd,
-            }
-            
-            # 3. 创建受限的命名空间
-            restricted_globals = {
-                '__builtins__': safe_builtins,
-                'pd': pd,
-                'pandas': pd,
-            }
-            
-            # 4. 使用copy保护原始数据
-            local_vars = {
-                "df": df.copy(),
-                "pd": pd,
-            }
-            
-            # 5. 执行代码
-            exec(code, restricted_globals, local_vars)
-            
-            # 6. 获取结果
-            result = local_vars.get('result', "No result")
-            result_container["result"] = result
-            result_container["completed"] = True
-            
-        except Exception as e:
-            result_container["error"] = str(e)
-            result_container["completed"] = True
-    
-    # 创建执行线程
-    exec_thread = threading.Thread(target=restricted_exec)
-    exec_thread.daemon = True  # 设置为守护线程
-    exec_thread.start()
-    exec_thread.join(timeout=timeout)
-    
-    # 检查是否超时
-    if exec_thread.is_alive():
-        result_container["error"] = f"Code execution timeout (>{timeout}s)"
-        result_container["completed"] = True
-        # 注意：daemon线程会在主线程退出时自动终止
-        # 但无法强制终止正在执行的代码
-    
-    # 返回结果
-    if result_container["error"]:
-        return False, None, result_container["error"]
-    else:
-        return True, result_container["result"], None
+    prompt中的样例和示例代码都按字符串比较日期（如 df['Date'] == '2023-01-01'），
+    date32列与字符串比较会返回空结果或抛出TypeError。
+    """
+    import pyarrow as pa
+    temporal = [
+        col for col, dtype in df.dtypes.items()
+        if isinstance(dtype, get_pandas().ArrowDtype) and pa.types.is_temporal(dtype.pyarrow_dtype)
+    ]
+    if not temporal:
+        return df
+    return df.astype({col: get_pandas().ArrowDtype(pa.string()) for col in temporal})
+
+def read_csv_fast(source):
+    """
+    优先使用pyarrow多线程解析CSV，失败时（未安装或格式不兼容）回退到默认C引擎
+    
+    两种引擎都返回Arrow类型的列，日期/时间列保留为字符串
+    """
+    pd = get_pandas()
+    try:
+        df = pd.read_csv(source, engine="pyarrow", dtype_backend="pyarrow")
+        # pyarrow引擎会保留重复的列名，Arrow表和feather都不接受
+        df.columns = dedup_column_names(df.columns)
+        return temporal_columns_to_string(df)
+    except Exception as e:
+        print(f"[WARNING] pyarrow CSV engine failed, falling back to C engine: {e}")
+        if hasattr(source, "seek"):
+            source.seek(0)  # 文件流已被读取过，回到开头重新解析
+        return pd.read_csv(source, dtype_backend="pyarrow")
+
+def is_code_finished(content):
+    """
+    判断不带markdown代码块的回复是否已经写完代码
+    
+    最后一个完整行是解释文本（_SKIP_TEXT_RE，且本身不是合法代码），
+    并且之前的代码（去掉解释文本行）能编译、已在顶层给result赋值。
+    """
+    lines = content[:content.rfind("\n")].split("\n")
+    last_line = lines.pop().strip()
+    if not last_line or last_line.startswith("#") or not _SKIP_TEXT_RE.match(last_line):
+        return False
+    code = "\n".join(line for line in lines if not _SKIP_TEXT_RE.match(line.strip()))
+    if not _RESULT_ASSIGN_RE.search(code):
+        return False
+    try:
+        compile(last_line, "<line>", "exec")
+        return False  # 看起来像解释文本，实际上是代码
+    except SyntaxError:
+        pass
+    try:
+        compile(code, "<ai_generated>", "exec")
+    except SyntaxError:
+        return False
+    return True
+
+def request_completion(model, system_role, prompt):
+    """
+    向OpenRouter发起一次流式chat completion请求，返回回复内容
+    
+    代码写完后就提前结束流（之后只会是解释文本，提取代码时也会被丢弃）：
+    - 用markdown代码块包裹代码时，代码块闭合后结束
+    - 按prompt要求直接输出代码时，出现第一行解释文本、且之前的代码完整并已赋值result后结束
+    否则一直读到模型自己结束。
+    """
+    stream = get_client().chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_role},
+            {"role": "user", "content": prompt}
+        ],
+        extra_headers={
+            "HTTP-Referer": "http://localhost:5000",
+            "X-Title": "Chat with AI",
+        },
+        temperature=0.1,
+        stream=True
+    )
+    content = ""
+    try:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            content += delta
+            if "`" in delta and _CLOSED_CODE_BLOCK_RE.search(content):
+                break
+            if "\n" in delta and is_code_finished(content):
+                break
+    finally:
+        stream.close()
+    return content
 
 def ask_ai(prompt, system_role="You are a helpful data assistant.", model_name="google"):
+    model = MODEL_MAP.get(model_name, MODEL_MAP["google"])
+    cache_key = response_cache_key(model, system_role, prompt)
+    
+    # 先查精确匹配缓存；若相同请求正在进行中，则合并到同一次LLM调用
+    with RESPONSE_CACHE_LOCK:
+        if cache_key in RESPONSE_CACHE:
+            RESPONSE_CACHE.move_to_end(cache_key)
+            return RESPONSE_CACHE[cache_key]
+        pending = INFLIGHT_REQUESTS.get(cache_key)
+        if pending is None:
+            pending = INFLIGHT_REQUESTS[cache_key] = concurrent.futures.Future()
+            is_leader = True
+        else:
+            is_leader = False
+    
+    if not is_leader:
+        return pending.result()
+    
+    content = None
     try:
-        model = MODEL_MAP.get(model_name, MODEL_MAP["google"])
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": system_role},
-                {"role": "user", "content": prompt}
-            ],
-            extra_headers={
-                "HTTP-Referer": "http://localhost:5000",
-                "X-Title": "Chat with AI",
-            },
-            temperature=0.1
-        )
-        return response.choices[0].message.content
+        # 回复在代码执行成功后才由chat()写入缓存
+        content = request_completion(model, system_role, prompt)
     except Exception as e:
         print(f"AI Error: {e}")
-        return None
+    finally:
+        with RESPONSE_CACHE_LOCK:
+            INFLIGHT_REQUESTS.pop(cache_key, None)
+        pending.set_result(content)
+    return content
+
+def format_answer(result_html, explanation_html=""):
+    """拼接最终回复：可选的思路/代码部分 + 分析结果"""
+    return (
+        f"{explanation_html}"
+        "<div style='background-color: #e8f5e9; padding: 12px; border-radius: 8px; border-left: 4px solid #4caf50;'>"
+        f"<strong>✅ Analysis Result:</strong><br>{result_html}</div>"
+    )
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
@@ -269,16 +873,22 @@ def upload_file():
         return jsonify({"error": "No selected file"}), 400
 
     try:
-        filepath = os.path.join(UPLOAD_FOLDER, file.filename)
-        file.save(filepath)
-        df = pd.read_csv(filepath)
+        # 直接从上传的文件流解析，不落盘
+        # 写入共享内存，沙箱进程执行代码时无需再序列化传输DataFrame；
+        # 父进程也只保留共享内存上的视图，解析出的私有副本随即释放
+        shared_df = share_dataframe(read_csv_fast(file.stream))
+        df = map_shared_dataframe(shared_df)
         
         # 生成session_id并缓存DataFrame
         session_id = str(uuid.uuid4())
-        sessions[session_id] = {
+        save_session(session_id, {
             "df": df,
-            "filename": file.filename
-        }
+            "filename": file.filename,
+            # 预先计算prompt需要的列名和样例数据，避免每次chat重复计算
+            "columns": list(df.columns),
+            "sample": build_prompt_sample(df),
+            "shared_df": shared_df
+        })
         
         welcome_message = f"File {file.filename} uploaded successfully! Dataset contains {len(df)} rows and {len(df.columns)} columns."
         
@@ -299,16 +909,30 @@ def chat():
     prompt_strategy = data.get('prompt_strategy', 'direct')  # 获取prompt策略，默认direct
     session_id = data.get('session_id')  # 从请求中获取session_id
     
-    if not session_id or session_id not in sessions:
+    session = get_session(session_id)
+    if session is None:
         return jsonify({"answer": "Please upload a file first!", "type": "text"})
     
-    # 从session缓存中获取DataFrame（使用copy避免被修改）
-    original_df = sessions[session_id]["df"]
-    current_df = original_df.copy()  # 使用copy，防止AI代码修改原始数据
+    # 从session缓存中获取DataFrame（执行时由CoW浅拷贝保护，这里无需复制）
+    current_df = session["df"]
+    
+    # direct策略下的简单问题（行数、列名等）直接用pandas回答，跳过LLM调用
+    if prompt_strategy == "direct":
+        routed = route_trivial_question(user_question, current_df)
+        if routed is not None:
+            print(f"[DEBUG] Routed trivial question without LLM: {user_question}")
+            routed_result, notice = routed
+            notice_html = ""
+            if notice:
+                notice_html = (
+                    "<div style='background-color: #fff8e1; padding: 12px; border-radius: 8px; margin-bottom: 12px; border-left: 4px solid #ffb300;'>"
+                    f"ℹ️ {escape(notice)}</div>"
+                )
+            return jsonify({"answer": format_answer(sandbox.render_result(routed_result), notice_html), "type": "text"})
     
-    # 获取数据信息用于prompt
-    columns = list(current_df.columns)
-    row_sample = current_df.head(2).to_dict()
+    # 获取数据信息用于prompt（上传时已缓存）
+    columns = session["columns"]
+    row_sample = session["sample"]
 
     # 根据策略选择对应的prompt模板
     prompt_template = PROMPT_TEMPLATES.get(prompt_strategy, PROMPT_TEMPLATES["direct"])
@@ -328,7 +952,13 @@ def chat():
     else:  # direct
         system_role = "You are a Python code generator. Output ONLY executable Python code. No markdown, no explanations."
     
-    code = ask_ai(prompt, system_role, model_name)
+    # 先查语义缓存：相似问题直接复用之前生成的代码，跳过LLM调用
+    question_embedding = embed_question(user_question)
+    code = semantic_cache_lookup(session_id, prompt_strategy, model_name, user_question, question_embedding)
+    cache_hit = code is not None
+    if code is None:
+        code = ask_ai(prompt, system_role, model_name)
+    raw_response = code
     
     if code is None:
         return jsonify({
@@ -336,80 +966,10 @@ def chat():
             "type": "text"
         })
     
-    # 清理和提取代码（保留思路注释和缩进）
-    original_code_with_comments = None
+    # 清理和提取代码（保留思路注释和缩进），同时得到用于展示的思路要点
+    reasoning = []
     if code:
-        # 保存原始代码（包含注释）用于显示思路
-        original_code_with_comments = code.replace("```python", "").replace("```", "").strip()
-        
-        # 移除markdown代码块标记
-        code = code.replace("```python", "").replace("```", "").strip()
-        
-        # 提取代码：找到包含 "result" 的行，但保留注释和缩进
-        lines = code.split('\n')
-        code_lines = []
-        reasoning_lines = []  # 保存思路注释
-        
-        for line in lines:
-            original_line = line
-            line_stripped = line.strip()
-            if not line_stripped:
-                continue
-            
-            # 跳过明显的解释文本（非代码注释）
-            if line_stripped.lower().startswith(('note:', 'example:', 'here', 'this code', 'the code', 'you can')):
-                continue
-            
-            # ⚠️ 移除重新定义df的代码行（防止bug）
-            if line_stripped.startswith('df = pd.DataFrame') or line_stripped.startswith('df = DataFrame'):
-                print(f"[WARNING] Removed DataFrame recreation: {line_stripped}")
-                continue
-            
-            # 保留思路注释（以#开头的注释，特别是Step、Reasoning相关的）
-            if line_stripped.startswith('#') and ('step' in line_stripped.lower() or 'logic' in line_stripped.lower() or 'explain' in line_stripped.lower() or 'approach' in line_stripped.lower() or 'reason' in line_stripped.lower() or 'reasoning' in line_stripped.lower() or 'analyze' in line_stripped.lower()):
-                reasoning_lines.append(original_line)  # 保留原始格式（包括缩进）
-            
-            # 收集包含 result 或看起来像代码的行
-            if 'result' in line_stripped or ('=' in line_stripped and ('df' in line_stripped or 'pd' in line_stripped)) or line_stripped.startswith('if ') or line_stripped.startswith('for ') or line_stripped.startswith('while ') or line_stripped.startswith('def '):
-                code_lines.append(original_line)  # 保留原始格式（包括缩进）
-            elif code_lines:  # 如果已经开始收集代码，继续收集后续行
-                # 保留所有注释行（包括思路注释）
-                if line_stripped.startswith('#'):
-                    reasoning_lines.append(original_line)
-                elif not line_stripped.lower().startswith(('note', 'example')):
-                    # 检查是否是代码的延续（如if/for/while的缩进块）
-                    if original_line and (original_line[0].isspace() or line_stripped.startswith(('if ', 'elif ', 'else:', 'for ', 'while ', 'def ', 'return ', 'import ', 'from '))):
-                        code_lines.append(original_line)  # 保留原始格式（包括缩进）
-        
-        # 如果提取到代码，使用提取的；否则使用原始（去除首尾空行）
-        if code_lines:
-            # 合并思路注释和代码，保持顺序
-            # 先添加所有思路注释，然后添加代码
-            all_lines = []
-            # 如果代码中有思路注释，先添加它们
-            for line in lines:
-                original_line = line
-                line_stripped = line.strip()
-                if line_stripped.startswith('#') and original_line in reasoning_lines:
-                    all_lines.append(original_line)
-            # 然后添加所有代码行（包括注释）
-            for line in lines:
-                original_line = line
-                line_stripped = line.strip()
-                if original_line in code_lines and original_line not in all_lines:
-                    all_lines.append(original_line)
-            
-            # 如果合并后为空，使用原始代码
-            if all_lines:
-                code = '\n'.join(all_lines)
-            else:
-                code = code.strip()
-        else:
-            code = code.strip()
-        
-        # 再次检查：如果代码中仍有重新定义df，给出警告
-        if 'df = pd.DataFrame' in code or 'df = DataFrame' in code:
-            print(f"[WARNING] Code still contains DataFrame recreation, may cause error")
+        code, reasoning = extract_code_and_reasoning(code)
     
     if not code or "Error code: 429" in code:
         return jsonify({
@@ -423,62 +983,52 @@ def chat():
     print(f"[DEBUG] Generated code: {code}")
     print(f"[DEBUG] DataFrame shape before execution: {current_df.shape}")
 
-    # 使用安全的代码执行函数
-    success, result, error = execute_code_safely(code, current_df, timeout=5)
+    # 使用安全的代码执行函数（在沙箱子进程中执行，返回渲染好的结果HTML）
+    success, result_html, error = execute_code_safely(code, session["shared_df"], timeout=5)
     
     if not success:
+        # 执行失败的代码不再复用，用户重试时重新生成
+        response_cache_discard(prompt, system_role, model_name)
+        semantic_cache_discard(session_id, raw_response)
         return jsonify({
             "answer": f"Code execution error: {error}\nGenerated code: {code}", 
             "type": "text"
         })
     
+    # 代码执行成功后才缓存LLM回复
+    if not cache_hit:
+        response_cache_store(prompt, system_role, model_name, raw_response)
+        semantic_cache_store(session_id, prompt_strategy, model_name, user_question, question_embedding, raw_response)
+    
     # 调试：打印结果
-    print(f"[DEBUG] Result type: {type(result)}, Value: {result}")
+    print(f"[DEBUG] Result: {result_html}")
     
     # 构建回复（包含思路和结果）
-    answer_parts = []
-    
-    # 对于CoT和Few-Shot策略，显示思路
+    # 对于CoT和Few-Shot策略，显示思路和生成的代码
+    explanation_html = ""
     if prompt_strategy in ["cot", "few_shot"]:
-        # 提取思路注释
-        reasoning = []
-        if original_code_with_comments:
-            for line in original_code_with_comments.split('\n'):
-                line = line.strip()
-                # 提取思路注释：Step、Reasoning、Logic、Explain、Approach等关键词
-                if line.startswith('#') and ('step' in line.lower() or 'logic' in line.lower() or 'explain' in line.lower() or 'approach' in line.lower() or 'reason' in line.lower() or 'reasoning' in line.lower() or 'analyze' in line.lower()):
-                    # 移除#号，保留内容
-                    reasoning_text = line.lstrip('#').strip()
-                    if reasoning_text:
-                        reasoning.append(reasoning_text)
-        
+        reasoning_html = ""
         if reasoning:
-            answer_parts.append("<div style='background-color: #f0f7ff; padding: 12px; border-radius: 8px; margin-bottom: 12px; border-left: 4px solid #007bff;'>")
-            answer_parts.append("<strong>💭 Reasoning Steps:</strong><br>")
-            for i, step in enumerate(reasoning, 1):
-                answer_parts.append(f"{i}. {step}<br>")
-            answer_parts.append("</div>")
+            steps_html = "".join(f"{i}. {step}<br>" for i, step in enumerate(reasoning, 1))
+            reasoning_html = (
+                "<div style='background-color: #f0f7ff; padding: 12px; border-radius: 8px; margin-bottom: 12px; border-left: 4px solid #007bff;'>"
+                f"<strong>💭 Reasoning Steps:</strong><br>{steps_html}</div>"
+            )
         
         # 显示生成的代码（带格式）
-        answer_parts.append("<div style='background-color: #f8f9fa; padding: 12px; border-radius: 8px; margin-bottom: 12px;'>")
-        answer_parts.append("<strong>📝 Generated Code:</strong><br>")
-        answer_parts.append("<pre style='background-color: #2d2d2d; color: #f8f8f2; padding: 12px; border-radius: 6px; overflow-x: auto; margin: 8px 0;'>")
-        answer_parts.append(code.replace('<', '&lt;').replace('>', '&gt;'))
-        answer_parts.append("</pre>")
-        answer_parts.append("</div>")
-    
-    # 格式化结果
-    answer_parts.append("<div style='background-color: #e8f5e9; padding: 12px; border-radius: 8px; border-left: 4px solid #4caf50;'>")
-    answer_parts.append("<strong>✅ Analysis Result:</strong><br>")
-    if isinstance(result, pd.DataFrame):
-        answer_parts.append(result.to_html(classes='data-table', border=0))
-    else:
-        answer_parts.append(f"<div style='font-size: 18px; font-weight: bold; color: #2e7d32; margin-top: 8px;'>{str(result)}</div>")
-    answer_parts.append("</div>")
+        escaped_code = escape(code, quote=False)
+        explanation_html = (
+            f"{reasoning_html}"
+            "<div style='background-color: #f8f9fa; padding: 12px; border-radius: 8px; margin-bottom: 12px;'>"
+            "<strong>📝 Generated Code:</strong><br>"
+            "<pre style='background-color: #2d2d2d; color: #f8f8f2; padding: 12px; border-radius: 6px; overflow-x: auto; margin: 8px 0;'>"
+            f"{escaped_code}</pre></div>"
+        )
     
-    final_ans = ''.join(answer_parts)
+    final_ans = format_answer(result_html, explanation_html)
         
     return jsonify({"answer": final_ans, "type": "text"})
 
 if __name__ == '__main__':
-    app.run(port=5000, debug=True)
+    # 多线程模式：每个请求在独立线程中处理，等待LLM返回时不会阻塞其他请求
+    app.run(port=5000, debug=True, threaded=True)
@@ -0,0 +1,213 @@
+"""
+AI生成代码的沙箱工作进程（方案2：进程隔离）
+
+app.py启动时预先创建一组工作进程（见app.py的SandboxPool），每个进程循环处理任务：
+- 接收: (code, (shm_name, size), timeout)，DataFrame由父进程以Arrow IPC格式写在共享内存中
+- 返回: JSON字节 {"success": bool, "result": str, "error": str}，result为已渲染好的HTML
+
+工作进程通过 resource.setrlimit 限制CPU时间和内存，超时后由父进程直接kill并补充新进程，
+不会像线程那样在后台一直占用CPU。
+"""
+import sys
+import json
+import atexit
+from collections import OrderedDict
+
+try:
+    import resource  # 仅Unix可用；Windows上只依赖父进程的超时kill
+except ImportError:
+    resource = None
+
+# 每次执行时，在进程当前虚拟内存（已导入的pandas/pyarrow、已映射的共享内存DataFrame等）基础上
+# 最多还能再申请的地址空间（计算中间结果、Arrow线程栈等）
+MEMORY_HEADROOM_BYTES = 2 * 1024 ** 3
+
+# 1. 安全的内置函数字典（移除危险函数）
+SAFE_BUILTINS = {
+    # 基础类型
+    'len': len, 'str': str, 'int': int, 'float': float,
+    'bool': bool, 'list': list, 'dict': dict, 'tuple': tuple,
+    'set': set, 'frozenset': frozenset,
+    # 基础操作
+    'min': min, 'max': max, 'sum': sum, 'abs': abs,
+    'round': round, 'sorted': sorted, 'reversed': reversed,
+    'enumerate': enumerate, 'zip': zip, 'range': range,
+    # 字符串操作
+    'ord': ord, 'chr': chr, 'hex': hex, 'oct': oct, 'bin': bin,
+    # 数学函数（如果需要，可以导入math模块）
+    # 移除的危险函数：
+    # - open, file (文件操作)
+    # - __import__, import (模块导入)
+    # - eval, exec, compile (代码执行)
+    # - input, raw_input (用户输入)
+    # - exit, quit (退出)
+    # - dir, vars, globals, locals (命名空间访问)
+}
+
+# 已编译的AI代码缓存，相同代码跳过解析和编译
+CODE_CACHE = OrderedDict()  # {code: code object}
+CODE_CACHE_MAX_ENTRIES = 512
+
+def compile_cached(code):
+    """编译代码并缓存字节码；语法错误照常抛出"""
+    compiled = CODE_CACHE.get(code)
+    if compiled is not None:
+        CODE_CACHE.move_to_end(code)
+        return compiled
+    compiled = compile(code, "<ai_generated>", "exec")
+    CODE_CACHE[code] = compiled
+    while len(CODE_CACHE) > CODE_CACHE_MAX_ENTRIES:
+        CODE_CACHE.popitem(last=False)
+    return compiled
+
+def _set_soft_limit(kind, soft):
+    """只修改软限制；硬限制保持不变（非root进程无法再调高硬限制）"""
+    _, hard = resource.getrlimit(kind)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(kind, (soft, hard))
+
+def current_virtual_memory():
+    """当前进程的虚拟内存大小（字节）；无法获取时（非Linux）返回None"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * resource.getpagesize()
+    except (OSError, ValueError):
+        return None
+
+def limit_resources(timeout):
+    """限制本进程接下来最多再使用timeout秒CPU时间，以及内存上限"""
+    if resource is None:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    _set_soft_limit(resource.RLIMIT_CPU, int(usage.ru_utime + usage.ru_stime) + timeout + 1)
+    
+    vm_size = current_virtual_memory()
+    if vm_size is None:
+        return
+    try:
+        _set_soft_limit(resource.RLIMIT_AS, vm_size + MEMORY_HEADROOM_BYTES)
+    except (ValueError, OSError) as e:
+        # 部分平台（如macOS）不支持限制RLIMIT_AS
+        print(f"[WARNING] Cannot limit sandbox memory: {e}", file=sys.stderr)
+
+def reset_resource_limits():
+    """任务结束后把软限制恢复到硬限制，下一个任务重新设置"""
+    if resource is None:
+        return
+    for kind in (resource.RLIMIT_CPU, resource.RLIMIT_AS):
+        _, hard = resource.getrlimit(kind)
+        resource.setrlimit(kind, (hard, hard))
+
+# 已映射的共享内存DataFrame（同一个session的后续请求直接复用）
+SHARED_FRAMES = OrderedDict()  # {shm_name: (SharedMemory, DataFrame)}
+SHARED_FRAMES_MAX_ENTRIES = 8
+# 映射的共享内存总大小上限，超过后淘汰最久未用的（当前任务的DataFrame始终保留）
+SHARED_FRAMES_MAX_BYTES = 1024 ** 3
+
+def load_shared_dataframe(name, size):
+    """
+    从共享内存映射DataFrame
+    
+    Arrow读取共享内存缓冲区时不复制数据，ArrowDtype列直接包装这些Arrow数组，
+    所以DataFrame只是共享内存上的视图。
+    """
+    import pandas as pd
+    import pyarrow as pa
+    from multiprocessing import shared_memory
+
+    cached = SHARED_FRAMES.get(name)
+    if cached is not None:
+        SHARED_FRAMES.move_to_end(name)
+        return cached[1]
+
+    shm = shared_memory.SharedMemory(name=name)
+    table = pa.ipc.open_stream(pa.py_buffer(shm.buf[:size])).read_all()
+    df = table.to_pandas(types_mapper=pd.ArrowDtype)
+    # 保持SharedMemory对象存活，DataFrame的数据引用着它的缓冲区
+    SHARED_FRAMES[name] = (shm, df)
+    while len(SHARED_FRAMES) > 1 and (
+        len(SHARED_FRAMES) > SHARED_FRAMES_MAX_ENTRIES
+        or sum(shm.size for shm, _ in SHARED_FRAMES.values()) > SHARED_FRAMES_MAX_BYTES
+    ):
+        release_oldest_shared_frame()
+    return df
+
+def release_oldest_shared_frame():
+    _, (shm, df) = SHARED_FRAMES.popitem(last=False)
+    del df  # 先释放DataFrame对缓冲区的引用，否则无法关闭共享内存
+    shm.close()
+
+@atexit.register
+def release_shared_frames():
+    while SHARED_FRAMES:
+        release_oldest_shared_frame()
+
+def enable_copy_on_write(pd):
+    """
+    开启Copy-on-Write：copy只是廉价的视图，只有被修改的列才会真正复制
+    
+    pandas 3起CoW是默认且唯一的行为，该选项已弃用，只在旧版本上设置
+    """
+    if int(pd.__version__.split(".")[0]) < 3:
+        pd.set_option("mode.copy_on_write", True)
+
+def render_result(result):
+    """把执行结果渲染成HTML：DataFrame渲染成表格，其他类型显示为文本"""
+    import pandas as pd
+    if isinstance(result, pd.DataFrame):
+        return result.to_html(classes='data-table', border=0)
+    return f"<div style='font-size: 18px; font-weight: bold; color: #2e7d32; margin-top: 8px;'>{str(result)}</div>"
+
+def run_restricted(code, df):
+    """在受限命名空间中执行代码，返回result变量的值"""
+    import pandas as pd
+
+    # 2. 创建受限的命名空间（只提供pandas）
+    restricted_globals = {
+        '__builtins__': SAFE_BUILTINS,
+        'pd': pd,
+        'pandas': pd,
+    }
+
+    # 3. 使用浅拷贝保护原始数据（CoW模式下不复制数据，写入时才按需复制）
+    local_vars = {
+        "df": df.copy(deep=False),
+        "pd": pd,
+    }
+
+    # 4. 执行代码（使用缓存的字节码）
+    exec(compile_cached(code), restricted_globals, local_vars)
+
+    # 5. 获取结果
+    return local_vars.get('result', "No result")
+
+def execute(code, df, timeout):
+    """限制资源后执行代码，返回可JSON序列化的响应"""
+    try:
+        limit_resources(timeout)
+        result = run_restricted(code, df)
+        return {"success": True, "result": render_result(result), "error": None}
+    except MemoryError:
+        return {"success": False, "result": None, "error": "Code execution exceeded memory limit"}
+    except Exception as e:
+        return {"success": False, "result": None, "error": str(e)}
+    finally:
+        reset_resource_limits()
+
+def worker_main(conn):
+    """工作进程主循环：预先导入pandas/pyarrow，然后逐个执行父进程发来的任务"""
+    import pandas
+    import pyarrow
+    enable_copy_on_write(pandas)
+    while True:
+        try:
+            code, (shm_name, size), timeout = conn.recv()
+        except EOFError:
+            break
+        try:
+            df = load_shared_dataframe(shm_name, size)
+            response = execute(code, df, timeout)
+        except Exception as e:
+            response = {"success": False, "result": None, "error": str(e)}
+        conn.send_bytes(json.dumps(response).encode())